@@ -20,16 +20,38 @@
 ###############################################################################
 
 import click
+import mmap
 import os
+import urllib.error
 import urllib.request
+import shutil
 import subprocess
+import sys
 import re
 import concurrent.futures
+import threading
+import traceback
 
-from json import dump, dumps, loads
-from time import sleep
+from json import loads
+from glob import glob
+from time import monotonic, sleep
 from distro import os_release_info
 
+# Use orjson to output results if it is available, since it is considerably
+# faster than the standard json library on the large nested results
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+except ImportError:
+    from json import dumps as json_dumps
+
+    def dumps(obj):
+        return json_dumps(obj, indent=4)
+
+
 test_source_files = {
     "2160p-hevc": {
         "url": "https://repo.jellyfin.org/jellyfish/media/jellyfish-120-mbps-4k-uhd-hevc-10bit.mkv",
@@ -50,14 +72,14 @@ test_source_files = {
 }
 
 ffmpeg_streams = {
-    "cpu-h264": "{ffmpeg} -c:v h264 -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale=trunc(min(max(iw\,ih*a)\,{scale})/2)*2:trunc(ow/a/2)*2,format=yuv420p -c:v libx264 -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "cpu-hevc": "{ffmpeg} -c:v hevc -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale=trunc(min(max(iw\,ih*a)\,{scale})/2)*2:trunc(ow/a/2)*2,format=yuv420p -c:v libx265 -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "nvenc-h264": "{ffmpeg} -init_hw_device cuda=cu:{gpu} -hwaccel cuda -hwaccel_output_format cuda -c:v h264_cuvid -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_cuda=-1:{scale}:yuv420p -c:v h264_nvenc -preset p1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "nvenc-hevc": "{ffmpeg} -init_hw_device cuda=cu:{gpu} -hwaccel cuda -hwaccel_output_format cuda -c:v hevc_cuvid -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_cuda=-1:{scale}:yuv420p -c:v hevc_nvenc -preset p1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "vaapi-h264": "ffmpeg -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -hwaccel vaapi -hwaccel_output_format vaapi -c:v h264 -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_vaapi=-1:{scale}:format=nv12 -c:v h264_vaapi -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "vaapi-hevc": "ffmpeg -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -hwaccel vaapi -hwaccel_output_format vaapi -c:v hevc -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_vaapi=-1:{scale}:format=nv12 -c:v hevc_vaapi -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "qsv-h264": "{ffmpeg} -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -init_hw_device qsv=qs@va -hwaccel qsv -hwaccel_output_format qsv -c:v h264_qsv -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_qsv=-1:{scale}:format=nv12 -c:v h264_qsv -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
-    "qsv-hevc": "{ffmpeg} -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -init_hw_device qsv=qs@va -hwaccel qsv -hwaccel_output_format qsv -c:v hevc_qsv -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_qsv=-1:{scale}:format=nv12 -c:v hevc_qsv -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "cpu-h264": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -c:v h264 -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale=trunc(min(max(iw\,ih*a)\,{scale})/2)*2:trunc(ow/a/2)*2,format=yuv420p -c:v libx264 -threads {threads} -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "cpu-hevc": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -c:v hevc -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale=trunc(min(max(iw\,ih*a)\,{scale})/2)*2:trunc(ow/a/2)*2,format=yuv420p -c:v libx265 -threads {threads} -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "nvenc-h264": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -init_hw_device cuda=cu:{gpu} -hwaccel cuda -hwaccel_output_format cuda -c:v h264_cuvid -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_cuda=-1:{scale}:yuv420p -c:v h264_nvenc -threads 1 -preset p1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "nvenc-hevc": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -init_hw_device cuda=cu:{gpu} -hwaccel cuda -hwaccel_output_format cuda -c:v hevc_cuvid -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_cuda=-1:{scale}:yuv420p -c:v hevc_nvenc -threads 1 -preset p1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "vaapi-h264": "ffmpeg -hide_banner -nostats -progress pipe:2 -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -hwaccel vaapi -hwaccel_output_format vaapi -c:v h264 -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_vaapi=-1:{scale}:format=nv12 -c:v h264_vaapi -threads 1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "vaapi-hevc": "ffmpeg -hide_banner -nostats -progress pipe:2 -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -hwaccel vaapi -hwaccel_output_format vaapi -c:v hevc -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_vaapi=-1:{scale}:format=nv12 -c:v hevc_vaapi -threads 1 -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "qsv-h264": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -init_hw_device qsv=qs@va -hwaccel qsv -hwaccel_output_format qsv -c:v h264_qsv -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_qsv=-1:{scale}:format=nv12 -c:v h264_qsv -threads 1 -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
+    "qsv-hevc": "{ffmpeg} -hide_banner -nostats -progress pipe:2 -init_hw_device vaapi=va:/dev/dri/by-path/{gpu}-render -init_hw_device qsv=qs@va -hwaccel qsv -hwaccel_output_format qsv -c:v hevc_qsv -i {video_path}/{video_file} -autoscale 0 -an -sn -vf scale_qsv=-1:{scale}:format=nv12 -c:v hevc_qsv -threads 1 -preset veryfast -b:v {bitrate} -maxrate {bitrate} -f null - -benchmark",
 }
 
 scaling = {
@@ -78,85 +100,236 @@ scaling = {
     },
 }
 
+# The GPU vendor (as reported by lshw) required by each hardware method
+method_vendors = {
+    "nvenc": "NVIDIA Corporation",
+    "vaapi": "Advanced Micro Devices, Inc. [AMD/ATI]",
+    "qsv": "Intel Corporation",
+}
+
+# The GPU vendors that we know how to test
+known_gpu_vendors = frozenset(method_vendors.values())
+
+# The typical maximum number of simultaneous sessions for each method, used to
+# avoid ramping workers straight past a hardware or driver limit; NVIDIA consumer
+# cards are limited to 8 unless the driver unlock patch is applied
+session_hints = {
+    "cpu": 256,
+    "nvenc": 8,
+    "vaapi": 16,
+    "qsv": 16,
+}
+
+# The length of the runs used to search for the maximum number of streams; the
+# speed is taken from the first frame after 500 (of 900), so stopping all workers
+# shortly after that point is enough to steer the search in two thirds of the
+# time. These runs are not reported; the maximum found is confirmed by a run of
+# the full clip, which is.
+probe_seconds = 20
+
 debug = False
 
+# The thread pool which runs the ffmpeg workers, shared by all runs
+worker_pool = None
+worker_pool_size = 0
+
+# Environment for the ffmpeg processes; lazy CUDA module loading and fewer
+# device connections make CUDA context creation much cheaper for each NVENC
+# worker, and are ignored by everything else. Values already set in the
+# environment take precedence.
+cuda_env = {
+    "CUDA_DEVICE_MAX_CONNECTIONS": "2",
+    "CUDA_MODULE_LOADING": "LAZY",
+}
 
-def run_ffmpeg(cmd, pid, is_cpu=False):
-    # For workers wait 1/100th of a second before starting to ensure the first
-    # worker can always start
-    if pid > 1:
-        sleep(0.01)
+# Placeholder argument for the per-worker thread count in prepared commands
+THREADS_ARG = "{threads}"
+
+# Used to pin each CPU stream worker to its own CPUs, if available
+taskset_path = shutil.which("taskset")
 
+# Fixed encoder thread count for CPU streams, overriding the size of each
+# worker's CPU set
+ffmpeg_threads = os.environ.get("JELLYFIN_FFMPEG_THREADS")
+
+# The most simultaneous CPU stream workers to start for each usable CPU
+max_workers_per_cpu = 4
+
+# Persistent state between runs, i.e. the hardware information and the test
+# files known to be valid
+state_path = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "hwatest",
+    "state.json",
+)
+state_lock = threading.Lock()
+
+# Patterns used throughout the program, compiled once at import; those used to
+# parse the ffmpeg stderr output are applied to single raw (bytes) lines by
+# StderrParser, so only the few values kept are ever decoded
+_FFMPEG_VERSION_RE = re.compile(r"ffmpeg version (.*) Copyright")
+_FFMPEG_ENCODER_RE = re.compile(r"^ V.{5} (\w+)", re.M)
+_FAIL_RE = re.compile(
+    rb"(?: failed: (?P<a>[^(\n]+)\([0-9]+\)| failed -> [^\n]*: (?P<b>[^\n]+)| failed!: (?P<d>[^\n]+?) \(-?[0-9]+\)|^Error (?P<c>[^\n]+))",
+    re.M,
+)
+_PROGRESS_FRAME_RE = re.compile(rb"^frame=([0-9]+)$", re.M)
+_PROGRESS_SPEED_RE = re.compile(rb"^speed=\s*([0-9.]+)x$", re.M)
+_UTIME_RE = re.compile(rb"^bench: utime=\S+ stime=\S+ rtime=([0-9.]+)s", re.M)
+_RSS_RE = re.compile(rb"^bench: maxrss=([0-9]+)", re.M)
+
+
+def get_usable_cpus():
+    # Count the CPUs we are allowed to run on, which inside a container or with a
+    # restricted affinity can be far fewer than the CPUs in the system
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def split_cpus(workers):
+    # Split the CPUs we are allowed to run on into one equal, disjoint set per
+    # worker, so that every worker runs under the same conditions as the measured
+    # first one; any leftover CPUs are left unused. If there are at least as many
+    # workers as CPUs, nothing is pinned and the kernel balances the workers.
+    cpus = sorted(os.sched_getaffinity(0))
+    if workers >= len(cpus):
+        return [None] * workers
+    per_worker = len(cpus) // workers
+    return [set(cpus[i * per_worker : (i + 1) * per_worker]) for i in range(workers)]
+
+
+class StderrParser:
+    """
+    Parse ffmpeg output one line at a time, keeping the first match of each
+    value we care about
+    """
+
+    def __init__(self, results=True):
+        # Only the first worker reports results; the others only need to report
+        # why they failed, plus their time when debugging
+        self.results = results
+        self.failure = None
+        self.frame = None
+        self.time = None
+        self.rss = None
+        self.progress_frame = 0
+
+    def feed(self, line):
+        # Dispatch on the start of the line so that each line is checked against
+        # at most one pattern
+        if line.startswith(b"frame="):
+            # Progress blocks give the frame count first and the speed later on
+            if self.results:
+                match = _PROGRESS_FRAME_RE.match(line)
+                if match is not None:
+                    self.progress_frame = int(match.group(1))
+        elif line.startswith(b"speed="):
+            # We want to find the speed from the first block at or after frame
+            # 500 out of 900
+            if self.results and self.frame is None and self.progress_frame >= 500:
+                match = _PROGRESS_SPEED_RE.match(line)
+                if match is not None:
+                    self.frame = (self.progress_frame, float(match.group(1)))
+        elif line.startswith(b"bench: utime"):
+            if (self.results or debug) and self.time is None:
+                self.time = _UTIME_RE.match(line)
+        elif line.startswith(b"bench: maxrss"):
+            if self.results and self.rss is None:
+                self.rss = _RSS_RE.match(line)
+        elif self.failure is None:
+            self.failure = _FAIL_RE.search(line)
+
+    def read(self, stderr):
+        # The pipe must always be drained so ffmpeg never blocks on it, but once
+        # everything has been found the rest of the output can be skipped
+        for line in stderr:
+            if self.frame is None or self.time is None or self.rss is None:
+                self.feed(line)
+
+
+def run_ffmpeg(split_cmd, pid, barrier, is_cpu=False, cpu_set=None):
     if is_cpu:
         timeout = None
     else:
         timeout = 60
 
-    split_cmd = cmd.split()
+    # Pin the ffmpeg process to its own CPUs if we were given some; this is done
+    # with taskset rather than in the forked child, which is not safe from threads
+    if cpu_set is not None and taskset_path is not None:
+        split_cmd = [
+            taskset_path,
+            "-c",
+            ",".join(str(cpu) for cpu in sorted(cpu_set)),
+        ] + split_cmd
+
+    failure_reason = None
+    # Wait for all other workers to be ready so that every ffmpeg instance starts
+    # at the same time; if the barrier breaks, just start anyway
+    try:
+        barrier.wait(timeout=5)
+    except threading.BrokenBarrierError:
+        pass
+
     # Timeout is 120s as this is 4x the length of the clip (and longer than any reasonable run should take)
+    parser = StderrParser(results=pid == 1)
     try:
-        output = subprocess.run(
+        process = subprocess.Popen(
             split_cmd,
-            stdin=subprocess.PIPE,
-            capture_output=True,
-            universal_newlines=True,
-            timeout=timeout,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            env=dict(cuda_env, **os.environ),
         )
-        retcode = output.returncode
-        ffmpeg_stderr = output.stderr
-    except subprocess.TimeoutExpired:
-        output = None
-        retcode = 255
-        ffmpeg_stderr = ""
-        failure_reason = "timeout/stuck"
+        # Kill ffmpeg if it is still running past the timeout, noting that we did;
+        # this closes its output and so ends the read below
+        timed_out = threading.Event()
+
+        def kill():
+            if process.poll() is None:
+                timed_out.set()
+                process.kill()
+
+        if timeout is not None:
+            killer = threading.Timer(timeout, kill)
+            killer.start()
+        try:
+            # Parse the output in this thread as it arrives, instead of holding
+            # all of it in memory
+            with process.stderr:
+                parser.read(process.stderr)
+            retcode = process.wait()
+        finally:
+            if timeout is not None:
+                killer.cancel()
+        if timed_out.is_set():
+            retcode = 255
+            failure_reason = "timeout/stuck"
     except Exception as e:
-        output = None
         retcode = 255
-        ffmpeg_stderr = ""
         failure_reason = f"generic failure {e}"
 
-    failure_reason = None
     if retcode > 0 and retcode < 255:
         # Figure out why we failed based on the ffmpeg output, the first error
         # found is canonical
-        for line in ffmpeg_stderr:
-            if re.search(r" failed: (.*)\([0-9]+\)", ffmpeg_stderr):
-                failure_reason = (
-                    re.search(r" failed: (.*)\([0-9]+\)", ffmpeg_stderr)
-                    .group(1)
-                    .strip()
-                )
-                break
-            elif re.search(r" failed -> (.*): (.*)", ffmpeg_stderr):
-                failure_reason = (
-                    re.search(r" failed -> (.*): (.*)", ffmpeg_stderr).group(2).strip()
-                )
-                break
-            elif re.search(r" failed -> (.*): (.*)", ffmpeg_stderr):
-                failure_reason = (
-                    re.search(r" failed!: (.*) \([0-9]+\))", ffmpeg_stderr)
-                    .group(1)
-                    .strip()
-                )
-                break
-            elif re.search(r"^Error (.*)", ffmpeg_stderr):
-                failure_reason = (
-                    re.search(r"^Error (.*)", ffmpeg_stderr).group(1).strip()
-                )
-                break
+        failure_match = parser.failure
+        if failure_match is not None:
+            failure_reason = next(
+                group.strip().decode(errors="replace")
+                for group in failure_match.groups()
+                if group is not None
+            )
         # If we can't find a good reason, it's just a generic failure
         if failure_reason is None:
             failure_reason = "generic failure"
 
     results = dict()
 
-    time_s = 0.0
-    for line in ffmpeg_stderr.split("\n"):
-        if re.match(r"^bench: utime", line):
-            timeline = line.split()
-            time_s = float(timeline[3].split("=")[-1].replace("s", ""))
+    time_match = parser.time
 
     if debug:
+        time_s = float(time_match.group(1)) if time_match is not None else 0.0
         click.echo(
             f">>>>> Worker {pid:02}: retcode: {retcode}, time: {time_s:.2f}s, failure reason: {failure_reason}"
         )
@@ -164,66 +337,131 @@ def run_ffmpeg(cmd, pid, is_cpu=False):
     if pid > 1:
         return (retcode, failure_reason, None)
 
-    for line in ffmpeg_stderr.split("\n"):
-        if re.match(r"^frame=", line):
-            # We want to find the speed from the first frame after 500 out of 900
-            if re.match(r"frame=\s*[5-9][0-9]+[0-9]+", line):
-                line = re.sub(r"=\s*", "=", line)
-                frameline = line.split()
-                break
-
-    for line in ffmpeg_stderr.split("\n"):
-        if re.match(r"^bench: utime", line):
-            timeline = line.split()
-        if re.match(r"^bench: maxrss", line):
-            rssline = line.split()
+    frame_match = parser.frame
+    rss_match = parser.rss
 
     try:
-        results["frame"] = int(frameline[0].split("=")[-1])
-        results["speed"] = float(frameline[6].split("=")[-1].replace("x", ""))
-        results["time_s"] = float(timeline[3].split("=")[-1].replace("s", ""))
-        results["rss_kb"] = float(rssline[1].split("=")[-1].replace("kB", ""))
+        results["frame"], results["speed"] = frame_match
+        results["time_s"] = float(time_match.group(1))
+        results["rss_kb"] = float(rss_match.group(1))
         return (retcode, failure_reason, results)
     except Exception:
         return (retcode, failure_reason, None)
 
 
-def do_benchmark(ffmpeg, video_path, video_file, stream, scale, workers, gpu):
-    stream_cmd = ffmpeg_streams[stream].format(
-        ffmpeg=ffmpeg,
-        video_path=video_path,
-        video_file=video_file,
-        scale=scaling[scale]["size"],
-        bitrate=scaling[scale]["bitrate"],
-        gpu=gpu,
-    )
+def get_stream_requirements(stream):
+    # The encoder is the last "-c:v" argument (any earlier one is the decoder),
+    # and the hardware acceleration methods follow any "-hwaccel" arguments
+    args = ffmpeg_streams[stream].split()
+    codecs = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == "-c:v"]
+    hwaccels = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == "-hwaccel"]
+    return (codecs[-1], hwaccels)
+
+
+def prepare_commands(ffmpeg, video_path, gpu):
+    # Format every stream, source file, and scale combination once up front. Each
+    # template is split into arguments before formatting, so that paths containing
+    # spaces stay intact and the escaped commas in the scale filters are passed to
+    # ffmpeg as-is. The thread count depends on the number of workers, so it is
+    # left as a placeholder argument for do_benchmark to fill in. Each command is
+    # stored along with whether it is a CPU stream.
+    prepared_cmds = dict()
+    for stream, template in ffmpeg_streams.items():
+        is_cpu = stream.startswith("cpu-")
+        for test_source in test_source_files.values():
+            video_file = test_source["url"].split("/")[-1]
+            for scale, scale_info in scaling.items():
+                stream_cmd = [
+                    arg.format(
+                        ffmpeg=ffmpeg,
+                        video_path=video_path,
+                        video_file=video_file,
+                        scale=scale_info["size"],
+                        bitrate=scale_info["bitrate"],
+                        gpu=gpu,
+                        threads=THREADS_ARG,
+                    )
+                    for arg in template.split()
+                ]
+                prepared_cmds[(stream, video_file, scale)] = (stream_cmd, is_cpu)
+    return prepared_cmds
+
+
+def get_worker_pool(size):
+    # Reuse one thread pool for the workers of every run, only replacing it with
+    # a larger one when a run needs more workers than it can run at once
+    global worker_pool, worker_pool_size
+    if worker_pool is None or worker_pool_size < size:
+        if worker_pool is not None:
+            worker_pool.shutdown(wait=False)
+        worker_pool = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+        worker_pool_size = size
+    return worker_pool
+
+
+def do_benchmark(stream_cmd, is_cpu, workers, probe_seconds=None):
+    # Limit the output duration for probe runs, just before the null output
+    if probe_seconds is not None:
+        output_idx = len(stream_cmd) - stream_cmd[::-1].index("-f") - 1
+        stream_cmd = (
+            stream_cmd[:output_idx]
+            + ["-t", str(probe_seconds)]
+            + stream_cmd[output_idx:]
+        )
+
+    # Refuse to start so many CPU workers that the system would be hopelessly
+    # oversubscribed; treat this as a failed run so the search backs off
+    if is_cpu and workers > get_usable_cpus() * max_workers_per_cpu:
+        return (2, ["too many workers for usable CPUs"], None)
 
-    if re.match(r"^cpu-", stream):
-        is_cpu = True
+    # For CPU streams, give each worker its own CPUs and a matching number of
+    # encoder threads, so the workers do not all contend for the same cores; if
+    # the workers cannot be pinned, each gets a single thread
+    if is_cpu:
+        cpu_sets = split_cpus(workers)
+        if cpu_sets[0] is not None:
+            threads = ffmpeg_threads or str(len(cpu_sets[0]))
+        else:
+            threads = ffmpeg_threads or "1"
+        stream_cmd = [threads if arg == THREADS_ARG else arg for arg in stream_cmd]
     else:
-        is_cpu = False
+        cpu_sets = [None] * workers
 
     results = None
     total_rets = 0
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers + 1) as executor:
-        future_to_results = {
-            executor.submit(run_ffmpeg, stream_cmd, i, is_cpu): i
-            for i in range(1, workers + 1, 1)
-        }
-
-        had_failure = False
-        failure_reasons = set()
-        for future in concurrent.futures.as_completed(future_to_results):
-            retcode, failure_reason, result = future.result()
-            total_rets += 1
-            # Get the first test result (all others are None)
-            if result is not None:
-                results = result
-            if retcode > 0 and retcode < 255:
-                had_failure = True
-            if failure_reason is not None:
-                failure_reasons.add(failure_reason)
-        failure_reasons = list(failure_reasons)
+    # The barrier is shared by all workers plus this thread, which releases them;
+    # this thread is not part of the pool, so it only needs one thread per worker
+    barrier = threading.Barrier(workers + 1)
+    executor = get_worker_pool(workers)
+    future_to_results = {
+        executor.submit(
+            run_ffmpeg,
+            stream_cmd,
+            i,
+            barrier,
+            is_cpu,
+            cpu_sets[i - 1],
+        ): i
+        for i in range(1, workers + 1, 1)
+    }
+    try:
+        barrier.wait(timeout=5)
+    except threading.BrokenBarrierError:
+        pass
+
+    had_failure = False
+    failure_reasons = set()
+    for future in concurrent.futures.as_completed(future_to_results):
+        retcode, failure_reason, result = future.result()
+        total_rets += 1
+        # Get the first test result (all others are None)
+        if result is not None:
+            results = result
+        if retcode > 0 and retcode < 255:
+            had_failure = True
+        if failure_reason is not None:
+            failure_reasons.add(failure_reason)
+    failure_reasons = list(failure_reasons)
 
     if results is None:
         return (1, failure_reasons, results)
@@ -233,18 +471,111 @@ def do_benchmark(ffmpeg, video_path, video_file, stream, scale, workers, gpu):
         return (0, failure_reasons, results)
 
 
+def load_state():
+    try:
+        with open(state_path, "r") as fh:
+            return loads(fh.read())
+    except Exception:
+        return dict()
+
+
+def save_state(section, value):
+    # Replace one section of the state file; this is locked as the hardware
+    # information and test files are handled concurrently
+    with state_lock:
+        state = load_state()
+        state[section] = value
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            write_results(state, state_path)
+        except Exception as e:
+            click.echo(f'Could not save state to "{state_path}": {e}')
+
+
+def write_results(results, path):
+    # Write to a temporary file and rename it over the target, so that the target
+    # is never left partially written if we are interrupted
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(dumps(results))
+    os.replace(tmp_path, path)
+
+
+def get_boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "r") as fh:
+            return fh.read().strip()
+    except Exception:
+        return None
+
+
+def split_lshw_classes(lshw_tree, hwclasses):
+    # Walk the full lshw tree and collect every node of the given classes, in
+    # the same flat form that "lshw -class" would output them
+    found = {hwclass: list() for hwclass in hwclasses}
+    nodes = lshw_tree if isinstance(lshw_tree, list) else [lshw_tree]
+    while nodes:
+        node = nodes.pop(0)
+        children = node.get("children", list())
+        if node.get("class") in found:
+            found[node["class"]].append(
+                {key: value for key, value in node.items() if key != "children"}
+            )
+        nodes = children + nodes
+    return found
+
+
+def run_probe(cmd):
+    # Run a system information command, returning None if it could not run at all
+    try:
+        return subprocess.run(cmd, capture_output=True)
+    except Exception:
+        return None
+
+
 def get_hwinfo(all_results, ffmpeg):
     all_results["hwinfo"] = dict()
 
     # Get our OS information from the distro library
     all_results["hwinfo"]["os"] = os_release_info()
 
+    # Reuse the hardware information from a previous run if the system has not
+    # rebooted since, as lshw is slow and the hardware cannot have changed; this
+    # must also be by the same user, as lshw gives incomplete information when
+    # not run as root, and the cached information must be complete
+    boot_id = get_boot_id()
+    cached_hwinfo = load_state().get("hwinfo", dict())
+    if (
+        boot_id is not None
+        and cached_hwinfo.get("boot_id") == boot_id
+        and cached_hwinfo.get("euid") == os.geteuid()
+        and all(hwclass in cached_hwinfo for hwclass in ["cpu", "memory", "gpu"])
+    ):
+        for hwclass in ["cpu", "memory", "gpu"]:
+            all_results["hwinfo"][hwclass] = cached_hwinfo[hwclass]
+        use_cached_hwinfo = True
+    else:
+        use_cached_hwinfo = False
+
+    # Run all of our probes at once, since they are independent of each other
+    probes = {
+        "version": [ffmpeg, "-version"],
+        "encoders": [ffmpeg, "-hide_banner", "-encoders"],
+        "hwaccels": [ffmpeg, "-hide_banner", "-hwaccels"],
+    }
+    if not use_cached_hwinfo:
+        probes["lshw"] = ["lshw", "-json"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        probe_futures = {
+            name: executor.submit(run_probe, cmd) for name, cmd in probes.items()
+        }
+        probe_outputs = {
+            name: future.result() for name, future in probe_futures.items()
+        }
+
     # Get our FFmpeg information
-    ffmpeg_output = subprocess.run(
-        [ffmpeg, "-version"],
-        capture_output=True,
-    )
-    if ffmpeg_output.returncode > 0:
+    ffmpeg_output = probe_outputs["version"]
+    if ffmpeg_output is None or ffmpeg_output.returncode > 0:
         click.echo(
             "Could not run 'ffmpeg'! Ensure you specified a valid Jellyfin FFmpeg path and try again."
         )
@@ -252,58 +583,327 @@ def get_hwinfo(all_results, ffmpeg):
     ffmpeg_information = ffmpeg_output.stdout.decode().split("\n")
     all_results["hwinfo"]["ffmpeg"] = dict()
     all_results["hwinfo"]["ffmpeg"]["path"] = ffmpeg
-    all_results["hwinfo"]["ffmpeg"]["version"] = re.match(
-        r"ffmpeg version (.*) Copyright", ffmpeg_information[0]
+    all_results["hwinfo"]["ffmpeg"]["version"] = _FFMPEG_VERSION_RE.match(
+        ffmpeg_information[0]
     ).group(1)
 
-    # Get our information using lshw because it is the most sensible output
-    try:
-        cpu_output = subprocess.run(
-            ["lshw", "-json", "-class", "cpu"],
-            capture_output=True,
+    # Get the encoders and hardware acceleration methods this FFmpeg supports, so
+    # that unsupported streams can be skipped rather than failing at runtime; if
+    # either cannot be determined, it is left as None and nothing is skipped.
+    # These are only used to pick the streams, so are not part of the results.
+    ffmpeg_features = dict()
+    encoders_output = probe_outputs["encoders"]
+    if encoders_output is None or encoders_output.returncode > 0:
+        ffmpeg_features["encoders"] = None
+    else:
+        ffmpeg_features["encoders"] = _FFMPEG_ENCODER_RE.findall(
+            encoders_output.stdout.decode()
         )
-        if cpu_output.returncode > 0:
-            raise
-    except Exception:
+    hwaccels_output = probe_outputs["hwaccels"]
+    if hwaccels_output is None or hwaccels_output.returncode > 0:
+        ffmpeg_features["hwaccels"] = None
+    else:
+        ffmpeg_features["hwaccels"] = [
+            line.strip()
+            for line in hwaccels_output.stdout.decode().split("\n")[1:]
+            if line.strip()
+        ]
+
+    if use_cached_hwinfo:
+        return (all_results, ffmpeg_features)
+
+    # Get our information using lshw because it is the most sensible output; a
+    # single run gives us the full tree, which we then split by class
+    lshw_output = probe_outputs["lshw"]
+    if lshw_output is None or lshw_output.returncode > 0:
         click.echo(
             "Could not run 'lshw'! The 'lshw' program is needed to gather required system information. Please install it and try again."
         )
         exit(1)
 
-    cpu_information = loads(cpu_output.stdout.decode())
-    all_results["hwinfo"]["cpu"] = cpu_information
-
-    memory_output = subprocess.run(
-        ["lshw", "-json", "-class", "memory"],
-        capture_output=True,
+    lshw_information = split_lshw_classes(
+        loads(lshw_output.stdout.decode()), ["processor", "memory", "display"]
     )
-    memory_information = loads(memory_output.stdout.decode())
-    all_results["hwinfo"]["memory"] = memory_information
+    all_results["hwinfo"]["cpu"] = lshw_information["processor"]
+    all_results["hwinfo"]["memory"] = lshw_information["memory"]
 
-    gpu_output = subprocess.run(
-        ["lshw", "-json", "-class", "display"],
-        capture_output=True,
-    )
-    gpu_information = loads(gpu_output.stdout.decode())
+    gpu_information = lshw_information["display"]
     # Discard any GPUs we don't recognize (i.e. not NVIDIA, AMD, or Intel)
-    for element in gpu_information.copy():
-        if element["vendor"] not in [
-            "NVIDIA Corporation",
-            "Advanced Micro Devices, Inc. [AMD/ATI]",
-            "Intel Corporation",
-        ]:
-            gpu_information.remove(element)
+    gpu_information = [
+        element
+        for element in gpu_information
+        if element.get("vendor") in known_gpu_vendors
+    ]
 
     all_results["hwinfo"]["gpu"] = gpu_information
 
-    return all_results
+    if boot_id is not None:
+        save_state(
+            "hwinfo",
+            {
+                "boot_id": boot_id,
+                "euid": os.geteuid(),
+                "cpu": all_results["hwinfo"]["cpu"],
+                "memory": all_results["hwinfo"]["memory"],
+                "gpu": all_results["hwinfo"]["gpu"],
+            },
+        )
+
+    return (all_results, ffmpeg_features)
+
+
+def read_temperatures():
+    # Read the current temperature of every thermal zone, in millidegrees C
+    temperatures = dict()
+    for zone in glob("/sys/class/thermal/thermal_zone*/temp"):
+        try:
+            with open(zone, "r") as fh:
+                temperatures[zone] = int(fh.read().strip())
+        except Exception:
+            continue
+    return temperatures
 
 
-def benchmark(ffmpeg, video_path, gpu_idx):
+def read_cpu_times():
+    # Read the total idle (including I/O wait) and overall CPU time, in ticks,
+    # from the aggregate line of /proc/stat; guest time is already counted in
+    # the user time, so only the first eight fields are summed
+    try:
+        with open("/proc/stat", "r") as fh:
+            fields = [int(field) for field in fh.readline().split()[1:9]]
+    except Exception:
+        return None
+    return (fields[3] + fields[4], sum(fields))
+
+
+def wait_cooldown(idle_temperatures, idle_threshold=0.9, max_wait=1.0):
+    # Let things settle between runs, by waiting until the CPUs are at least
+    # idle_threshold idle over the last 50ms and every thermal zone is back
+    # within 2 degrees C of its idle temperature, for at most max_wait seconds
+    deadline = monotonic() + max_wait
+    cpu_times = read_cpu_times()
+    while monotonic() < deadline:
+        sleep(0.05)
+        last_cpu_times, cpu_times = cpu_times, read_cpu_times()
+        if last_cpu_times is not None and cpu_times is not None:
+            idle_ticks = cpu_times[0] - last_cpu_times[0]
+            total_ticks = cpu_times[1] - last_cpu_times[1]
+            if total_ticks > 0 and idle_ticks / total_ticks < idle_threshold:
+                continue
+        temperatures = read_temperatures()
+        if all(
+            temperatures.get(zone, 0) <= idle_temperature + 2000
+            for zone, idle_temperature in idle_temperatures.items()
+        ):
+            return
+
+
+def get_remote_size(video_url):
+    # Ask the server for the current size of a test file without downloading it;
+    # if we cannot find out (e.g. we are offline), return None
+    request = urllib.request.Request(video_url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            remote_bytes = response.headers.get("Content-Length")
+    except Exception:
+        return None
+    if remote_bytes is not None and remote_bytes.isdigit():
+        return int(remote_bytes)
+    return None
+
+
+def download_file(video_url, video_file):
+    # Download into a separate partial file, which is only renamed into place once
+    # complete, so that only data we downloaded ourselves is ever resumed. The
+    # validator (ETag or Last-Modified) of the download is kept alongside it, and
+    # the rest of the file is only requested if the file on the server is still
+    # the same one; if it has changed, or cannot be checked, start again.
+    part_file = f"{video_file}.part"
+    validator_file = f"{part_file}.validator"
+    if os.path.exists(part_file) and os.path.exists(validator_file):
+        existing_bytes = os.path.getsize(part_file)
+        with open(validator_file, "r") as fh:
+            validator = fh.read().strip()
+    else:
+        existing_bytes = 0
+        validator = None
+    request = urllib.request.Request(video_url)
+    if existing_bytes > 0 and validator:
+        request.add_header("Range", f"bytes={existing_bytes}-")
+        request.add_header("If-Range", validator)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        response = urllib.request.urlopen(video_url)
+
+    # Stream the file straight to disk in 1MB chunks, and return the total size
+    # of the file along with the size the server told us to expect
+    with response:
+        if response.status == 206:
+            mode = "ab"
+            expected_bytes = response.headers.get("Content-Range", "").split("/")[-1]
+        else:
+            mode = "wb"
+            expected_bytes = response.headers.get("Content-Length")
+            # Weak ETags cannot be used to resume, so fall back to Last-Modified
+            validator = response.headers.get("ETag")
+            if validator is None or validator.startswith("W/"):
+                validator = response.headers.get("Last-Modified")
+            if validator:
+                with open(validator_file, "w") as fh:
+                    fh.write(validator)
+            elif os.path.exists(validator_file):
+                os.remove(validator_file)
+        with open(part_file, mode, buffering=1024 * 1024) as fh:
+            shutil.copyfileobj(response, fh, length=1024 * 1024)
+            actual_bytes = fh.tell()
+
+    if expected_bytes is not None and expected_bytes.isdigit():
+        expected_bytes = int(expected_bytes)
+    else:
+        expected_bytes = None
+    if expected_bytes is None or actual_bytes == expected_bytes:
+        os.replace(part_file, video_file)
+        if os.path.exists(validator_file):
+            os.remove(validator_file)
+    return (video_file, expected_bytes, actual_bytes)
+
+
+def read_available_memory():
+    # Read the memory available for new allocations without swapping, in bytes
+    try:
+        with open("/proc/meminfo", "r") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return None
+
+
+def prefault_test_files(video_path, video_files):
+    # Make sure the test files are entirely in the page cache before the first
+    # run, by mapping them with every page faulted in, so that reading them does
+    # not affect the results. This is only worth it if they can stay there next
+    # to the workers, i.e. with plenty of memory available.
+    total_bytes = sum(
+        os.path.getsize(f"{video_path}/{video_file}") for video_file in video_files
+    )
+    available_bytes = read_available_memory()
+    if available_bytes is None or available_bytes < total_bytes * 2:
+        return
+    for video_file in video_files:
+        with open(f"{video_path}/{video_file}", "rb") as fh:
+            with mmap.mmap(
+                fh.fileno(),
+                0,
+                flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0),
+                prot=mmap.PROT_READ,
+            ):
+                pass
+
+
+def abort(executor):
+    # Exit straight away, without waiting for the downloads still running in the
+    # executor to finish; the next run will resume them. If we are handling an
+    # unexpected error, show it first, as exiting this way skips the usual output.
+    executor.shutdown(wait=False, cancel_futures=True)
+    sys.stdout.flush()
+    error = sys.exc_info()[1]
+    if error is not None and not isinstance(error, SystemExit):
+        traceback.print_exc()
+    sys.stderr.flush()
+    os._exit(1)
+
+
+def make_run_result(workers, results):
+    return {
+        "workers": workers,
+        "frame": results["frame"],
+        "speed": results["speed"],
+        "time_s": results["time_s"],
+        "rss_kb": results["rss_kb"],
+    }
+
+
+def benchmark(ffmpeg, video_path, gpu_idx, checkpoint_path=None):
     video_files = list()
+    downloads = list()
+
+    # Files which were fully downloaded by a previous run, and are unchanged since,
+    # are known to be valid without further checks
+    valid_files = load_state().get("files", dict())
+
+    # Find the current size of every test file on the server at once, so that
+    # local files can be checked against it exactly
+    video_urls = [video["url"] for video in test_source_files.values()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(video_urls)) as executor:
+        remote_sizes = dict(zip(video_urls, executor.map(get_remote_size, video_urls)))
+
+    for video in test_source_files.values():
+        video_url = video["url"]
+        video_filename = video_url.split("/")[-1]
+        video_filesize = video["size"]
+        if not os.path.exists(f"{video_path}/{video_filename}"):
+            click.echo(f'File not found: "{video_path}/{video_filename}"')
+            file_invalid = True
+        else:
+            file_stat = os.stat(f"{video_path}/{video_filename}")
+            actual_filesize = int(file_stat.st_size / (1024 * 1024))
+            if remote_sizes[video_url] is not None:
+                file_invalid = file_stat.st_size != remote_sizes[video_url]
+                if file_invalid:
+                    # The file is stale or has changed on the server; it is left
+                    # in place until its replacement has been fully downloaded
+                    click.echo(
+                        f'File "{video_path}/{video_filename}" size is invalid: {file_stat.st_size} bytes not {remote_sizes[video_url]} bytes'
+                    )
+            elif valid_files.get(f"{video_path}/{video_filename}") == {
+                "mtime_ns": file_stat.st_mtime_ns,
+                "size": file_stat.st_size,
+            }:
+                file_invalid = False
+            elif actual_filesize != video_filesize:
+                click.echo(
+                    f'File "{video_path}/{video_filename}" size is invalid: {actual_filesize}MB not {video_filesize}MB'
+                )
+                file_invalid = True
+            else:
+                file_invalid = False
 
-    all_results = dict()
-    all_results = get_hwinfo(all_results, ffmpeg)
+        if file_invalid:
+            click.echo(
+                f'Downloading "{video_filename}" ({video_filesize}MB) to "{video_path}"...'
+            )
+            downloads.append((video_url, f"{video_path}/{video_filename}"))
+        else:
+            click.echo(
+                f'Found valid test file "{video_path}/{video_filename}" ({video_filesize}M).'
+            )
+
+        video_files.append(video_filename)
+
+    # Gather our hardware information while any missing test files download, since
+    # these are all independent and spend their time waiting on I/O
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(test_source_files) + 1
+    )
+    hwinfo_future = executor.submit(get_hwinfo, dict(), ffmpeg)
+    download_futures = [
+        executor.submit(download_file, video_url, video_file)
+        for video_url, video_file in downloads
+    ]
+
+    # Check the hardware first, so that any problem with it is reported right
+    # away instead of after all of the downloads have finished
+    try:
+        all_results, ffmpeg_features = hwinfo_future.result()
+    except BaseException:
+        abort(executor)
+
+    click.echo()
 
     if len(all_results["hwinfo"]["gpu"]) > 1:
         if gpu_idx is None:
@@ -319,7 +919,7 @@ def benchmark(ffmpeg, video_path, gpu_idx):
                 click.echo(
                     f"  {idx}: {gpu['vendor']} {gpu['product']} bus ID {gpu['businfo']}"
                 )
-            exit(1)
+            abort(executor)
         else:
             try:
                 gpu = all_results["hwinfo"]["gpu"][gpu_idx]
@@ -333,7 +933,7 @@ def benchmark(ffmpeg, video_path, gpu_idx):
                     click.echo(
                         f"  {idx}: {gpu['vendor']} {gpu['product']} bus ID {gpu['businfo']}"
                     )
-                exit(1)
+                abort(executor)
 
         # Handle nVidia multi-card, which needs a sequential ID instead of a bus ID; pass this as an idx to benchmark
         if gpu["vendor"] == "NVIDIA Corporation":
@@ -357,40 +957,33 @@ def benchmark(ffmpeg, video_path, gpu_idx):
     click.echo(f'''Using GPU "{gpu['vendor']} {gpu['product']}"''')
     click.echo()
 
-    for video in test_source_files.values():
-        video_url = video["url"]
-        video_filename = video_url.split("/")[-1]
-        video_filesize = video["size"]
-        if not os.path.exists(f"{video_path}/{video_filename}"):
-            click.echo(f'File not found: "{video_path}/{video_filename}"')
-            file_invalid = True
-        else:
-            actual_filesize = int(
-                os.stat(f"{video_path}/{video_filename}").st_size / (1024 * 1024)
-            )
-            if actual_filesize != video_filesize:
-                click.echo(
-                    f'File "{video_path}/{video_filename}" size is invalid: {actual_filesize}MB not {video_filesize}MB'
-                )
-                file_invalid = True
-            else:
-                file_invalid = False
-
-        if file_invalid:
-            click.echo(
-                f'Downloading "{video_filename}" ({video_filesize}MB) to "{video_path}"... ',
-                nl="",
-            )
-            urllib.request.urlretrieve(video_url, f"{video_path}/{video_filename}")
-            click.echo("done.")
-        else:
+    for future in concurrent.futures.as_completed(download_futures):
+        try:
+            video_file, expected_bytes, actual_bytes = future.result()
+        except BaseException:
+            abort(executor)
+        if expected_bytes is not None and actual_bytes != expected_bytes:
             click.echo(
-                f'Found valid test file "{video_path}/{video_filename}" ({video_filesize}M).'
+                f'Download of "{video_file}" is incomplete: {actual_bytes} bytes not {expected_bytes} bytes. Please re-run the test to try again.'
             )
+            abort(executor)
+        click.echo(f'Finished downloading "{video_file}" ({actual_bytes} bytes).')
+        file_stat = os.stat(video_file)
+        valid_files[video_file] = {
+            "mtime_ns": file_stat.st_mtime_ns,
+            "size": file_stat.st_size,
+        }
+    executor.shutdown()
+    if downloads:
+        save_state("files", valid_files)
+        click.echo()
 
-        video_files.append(video_filename)
+    prefault_test_files(video_path, video_files)
 
-    click.echo()
+    prepared_cmds = prepare_commands(ffmpeg, video_path, gpu_arg)
+    idle_temperatures = read_temperatures()
+
+    supported_vendors = frozenset(gpu["vendor"] for gpu in all_results["hwinfo"]["gpu"])
 
     all_results["tests"] = list()
     for stream in ffmpeg_streams.items():
@@ -402,17 +995,22 @@ def benchmark(ffmpeg, video_path, gpu_idx):
         stream_method = stream_type.split("-")[0]
         stream_encode = stream_type.split("-")[1]
 
-        supported_vendors = list()
-        for gpu in all_results["hwinfo"]["gpu"]:
-            supported_vendors.append(gpu["vendor"])
         if (
-            (stream_method == "nvenc" and "NVIDIA Corporation" not in supported_vendors)
-            or (
-                stream_method == "vaapi"
-                and "Advanced Micro Devices, Inc. [AMD/ATI]" not in supported_vendors
-            )
-            or (stream_method == "qsv" and "Intel Corporation" not in supported_vendors)
+            stream_method in method_vendors
+            and method_vendors[stream_method] not in supported_vendors
+        ):
+            continue
+
+        stream_encoder, stream_hwaccels = get_stream_requirements(stream_type)
+        ffmpeg_encoders = ffmpeg_features["encoders"]
+        ffmpeg_hwaccels = ffmpeg_features["hwaccels"]
+        if (ffmpeg_encoders is not None and stream_encoder not in ffmpeg_encoders) or (
+            ffmpeg_hwaccels is not None
+            and not set(stream_hwaccels).issubset(ffmpeg_hwaccels)
         ):
+            click.echo(
+                f"> Skipping {stream_type} encoder tests as FFmpeg does not support them"
+            )
             continue
 
         test_result["codec"] = stream_type
@@ -446,79 +1044,109 @@ def benchmark(ffmpeg, video_path, gpu_idx):
                 target_text = f"{source_resolution} -> {target_scale_name}"
                 click.echo(f">>> Running {target_text} tests")
 
+                stream_cmd, is_cpu = prepared_cmds[
+                    (stream_type, source_filename, target_resolution)
+                ]
                 workers = 1
                 max_streams = 0
-                scaleback = False
-                results = {"speed": 2.0}
+                # The lowest number of workers known to fail or to be too slow;
+                # once found, we bisect between it and max_streams
+                limit_workers = None
+                failure_reasons = list()
                 single_worker_speed = None
                 single_worker_rss_kb = 0.0
-                while results["speed"] > 1:
+                while True:
                     click.echo(
                         f">>>> Running test with {workers} simultaneous stream(s)..."
                     )
-                    code, failure_reasons, results = do_benchmark(
-                        ffmpeg,
-                        video_path,
-                        source_filename,
-                        stream_type,
-                        target_resolution,
+                    # The single worker run is reported, so it uses the full clip
+                    code, run_failure_reasons, results = do_benchmark(
+                        stream_cmd,
+                        is_cpu,
                         workers,
-                        gpu_arg,
+                        probe_seconds=probe_seconds if workers > 1 else None,
                     )
 
                     if code > 0 and workers == 1:
                         click.echo(
-                            f">>>> First worker failed (failure reason(s): {', '.join(failure_reasons)}) with one worker, aborting further tests with this stream type"
+                            f">>>> First worker failed (failure reason(s): {', '.join(run_failure_reasons)}) with one worker, aborting further tests with this stream type"
                         )
                         invalid_results = True
                         break
                     elif code > 0:
-                        if workers > max_streams + 1:
-                            click.echo(
-                                f">>>> More than one worker failed (failure reason(s): {', '.join(failure_reasons)}) with a large worker delta, scaling back and retrying"
+                        limit_workers = workers
+                        failure_reasons = run_failure_reasons
+                        click.echo(
+                            f">>>> More than one worker failed (failure reason(s): {', '.join(failure_reasons)})"
+                        )
+                    else:
+                        click.echo(
+                            f">>>> First worker speed: {results['speed']}x @ frame {results['frame']}, total time {results['time_s']}s"
+                        )
+
+                        if workers == 1:
+                            single_worker_speed = results["speed"]
+                            single_worker_rss_kb = results["rss_kb"]
+                            resmap_result["runs"].append(
+                                make_run_result(workers, results)
                             )
-                            workers -= int((workers - max_streams) / 2)
-                            results = {"speed": 2.0}
-                            scaleback = True
-                            sleep(1)
-                            continue
+
+                        if results["speed"] > 1:
+                            max_streams = workers
                         else:
-                            click.echo(
-                                f">>>> More than one worker failed (failure reason(s): {'. '.join(failure_reasons)}) with a small worker delta, aborting further tests at this encoding"
-                            )
-                            break
+                            limit_workers = workers
+                            failure_reasons = run_failure_reasons
 
+                    # Double the workers until a run fails or is too slow, then
+                    # binary search between the known good and known bad counts
+                    if limit_workers is not None and limit_workers - max_streams <= 1:
+                        break
+                    elif limit_workers is not None:
+                        # Bisect between the known good and known bad counts
+                        workers = int((max_streams + limit_workers) / 2)
+                    elif workers == 1:
+                        # A single stream at speed Nx can at best support N
+                        # simultaneous streams, so jump straight there
+                        workers = max(2, int(results["speed"]))
+                    else:
+                        workers *= 2
+
+                    # Stop at the usual session limit of the hardware before going
+                    # past it, since runs beyond it are likely to just fail; if it
+                    # works (e.g. an unlocked NVIDIA driver), keep ramping from there
+                    if (
+                        limit_workers is None
+                        and max_streams < session_hints[stream_method] < workers
+                    ):
+                        workers = session_hints[stream_method]
+                    wait_cooldown(idle_temperatures)
+
+                # Confirm the maximum with a run of the full clip, which is the
+                # one reported; if it does not hold up over the full clip, step
+                # down until it does (the single worker run is already full)
+                while not invalid_results and max_streams > 1:
                     click.echo(
-                        f">>>> First worker speed: {results['speed']}x @ frame {results['frame']}, total time {results['time_s']}s"
+                        f">>>> Confirming with {max_streams} simultaneous stream(s) over the full clip..."
                     )
-
-                    if workers == 1:
-                        single_worker_speed = results["speed"]
-                        single_worker_rss_kb = results["rss_kb"]
-
-                    run_result = {
-                        "workers": workers,
-                        "frame": results["frame"],
-                        "speed": results["speed"],
-                        "time_s": results["time_s"],
-                        "rss_kb": results["rss_kb"],
-                    }
-                    resmap_result["runs"].append(run_result)
-
-                    if results["speed"] >= 4 and not scaleback:
-                        max_streams = workers
-                        workers *= 4
-                        sleep(1)
-                    elif results["speed"] >= 2 and not scaleback:
-                        max_streams = workers
-                        workers *= 2
-                        sleep(1)
-                    elif results["speed"] > 1:
-                        max_streams = workers
-                        workers += 1
-                        sleep(1)
+                    code, run_failure_reasons, results = do_benchmark(
+                        stream_cmd, is_cpu, max_streams
+                    )
+                    if code == 0:
+                        click.echo(
+                            f">>>> First worker speed: {results['speed']}x @ frame {results['frame']}, total time {results['time_s']}s"
+                        )
+                        resmap_result["runs"].append(
+                            make_run_result(max_streams, results)
+                        )
+                        if results["speed"] > 1:
+                            break
                     else:
-                        break
+                        click.echo(
+                            f">>>> More than one worker failed (failure reason(s): {', '.join(run_failure_reasons)})"
+                        )
+                    failure_reasons = run_failure_reasons
+                    max_streams -= 1
+                    wait_cooldown(idle_temperatures)
 
                 if invalid_results:
                     break
@@ -538,13 +1166,18 @@ def benchmark(ffmpeg, video_path, gpu_idx):
 
                     test_result["resolutions"].append(resmap_result)
 
-                    sleep(1)
+                    wait_cooldown(idle_temperatures)
 
             if invalid_results:
                 break
 
         all_results["tests"].append(test_result)
 
+        # Save the results so far after each stream type, since a full run takes
+        # hours and would otherwise be lost entirely if interrupted
+        if checkpoint_path is not None:
+            write_results(all_results, checkpoint_path)
+
     return all_results
 
 
@@ -648,16 +1281,22 @@ def cli(ffmpeg_path, video_path, output_path, gpu_idx, debug_flag):
     if not os.path.exists(video_path):
         os.mkdir(video_path)
 
-    results = benchmark(ffmpeg_path, video_path, gpu_idx)
+    if output_path == "-":
+        checkpoint_path = None
+    else:
+        checkpoint_path = f"{output_path}.partial"
+
+    results = benchmark(ffmpeg_path, video_path, gpu_idx, checkpoint_path)
 
     click.echo()
     click.echo("Benchmark finished, outputting results...")
     if output_path == "-":
         click.echo()
-        click.echo(dumps(results, indent=4))
+        click.echo(dumps(results))
     else:
-        with open(output_path, "w") as fh:
-            dump(results, fh)
+        write_results(results, output_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
 
 def main():
@@ -8,6 +8,9 @@ setup(
         "Click",
         "distro",
     ],
+    extras_require={
+        "fast": ["orjson"],
+    },
     entry_points={
         "console_scripts": [
             "hwatest = hwatest.hwatest:cli",